@@ -25,9 +25,6 @@ import logging
 import sys
 from typing import Dict, Optional, Sequence, Type  # noqa: unused-import
 
-import pkg_resources
-from docopt import docopt
-
 from .protocol import (  # noqa: unused-import
     CommandSerialization,
     EventHandling,
@@ -37,6 +34,7 @@ from .protocol import (  # noqa: unused-import
     RepeaterProtocol,
     RflinkProtocol,
     create_rflink_connection,
+    new_event_loop,
 )
 
 PROTOCOLS = {
@@ -50,13 +48,37 @@ PROTOCOLS = {
 ALL_COMMANDS = ["on", "off", "allon", "alloff", "up", "down", "stop", "pair"]
 
 
+def package_version() -> str:
+    """Return version of installed rflink package."""
+    try:
+        from importlib.metadata import version
+    except ImportError:  # python < 3.8
+        import pkg_resources
+
+        return str(pkg_resources.require("rflink")[0].version)
+    return version("rflink")
+
+
+async def send_commands(
+    protocol: CommandSerialization, device_id: str, command: str, repeat: int
+) -> None:
+    """Submit all repetitions of a command at once.
+
+    The protocol serializes them, so each is sent as soon as the previous
+    one is acknowledged.
+    """
+    await asyncio.gather(
+        *(protocol.send_command_ack(device_id, command) for _ in range(repeat))
+    )
+
+
 def main(
     argv: Sequence[str] = sys.argv[1:], loop: Optional[asyncio.AbstractEventLoop] = None
 ) -> None:
     """Parse argument and setup main program loop."""
-    args = docopt(
-        __doc__, argv=argv, version=pkg_resources.require("rflink")[0].version
-    )
+    from docopt import docopt
+
+    args = docopt(__doc__, argv=argv, version=package_version())
 
     level = logging.ERROR
     if args["-v"]:
@@ -66,7 +88,7 @@ def main(
     logging.basicConfig(level=level)
 
     if not loop:
-        loop = asyncio.get_event_loop()
+        loop = new_event_loop()
 
     if args["--ignore"]:
         ignore = args["--ignore"].split(",")
@@ -99,10 +121,9 @@ def main(
     try:
         if command:
             assert isinstance(protocol, CommandSerialization)
-            for _ in range(int(args["--repeat"])):
-                loop.run_until_complete(
-                    protocol.send_command_ack(args["<id>"], command)
-                )
+            loop.run_until_complete(
+                send_commands(protocol, args["<id>"], command, int(args["--repeat"]))
+            )
         else:
             loop.run_forever()
     except KeyboardInterrupt:
@@ -5,15 +5,30 @@
 
 import logging
 import re
+import string
 import time
 from enum import Enum
-from typing import Any, Callable, DefaultDict, Dict, Generator, cast
+from functools import lru_cache
+from types import MappingProxyType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
 
 log = logging.getLogger(__name__)
 
 UNKNOWN = "unknown"
 SWITCH_COMMAND_TEMPLATE = "{node};{protocol};{id};{switch};{command};"
 PACKET_ID_SEP = "_"
+# number of distinct raw packets to remember validation/decoding results for
+PACKET_CACHE_SIZE = 1024
 
 # contruct regex to validate packets before parsing
 DELIM = ";"
@@ -73,36 +88,81 @@ PACKET_DEBUGRTS = DELIM.join(["20", SEQUENCE, "Debug", DEBUG_DATA_RTS])
 # 11;20;0B;NewKaku;ID=000005;SWITCH=2;CMD=ON;
 PACKET_DEVICE_CREATE = "11;" + PACKET_DEVICE
 
-PACKET_HEADER_RE = (
-    "^("
-    + "|".join(
-        [
-            PACKET_VERSION,
-            PACKET_DEVICE_CREATE,
-            PACKET_RESPONSE,
-            PACKET_DEVICE,
-            PACKET_COMMAND,
-            PACKET_COMMAND2,
-            PACKET_COMMAND3,
-            PACKET_COMMAND4,
-            PACKET_CONTROL,
-            PACKET_DEBUG,
-            PACKET_INFO,
-            PACKET_RFDEBUGN,
-            PACKET_RFUDEBUGN,
-            PACKET_RFDEBUGF,
-            PACKET_RFUDEBUGF,
-            PACKET_QRFDEBUGN,
-            PACKET_QRFDEBUGF,
-            PACKET_GPIOOFF,
-            PACKET_GPIOON,
-            PACKET_DEBUGRTS,
-        ]
-    )
-    + ");$"
+# packet formats grouped by their (literal) node header, see PacketHeader
+PACKET_FORMATS = {
+    "10": [
+        PACKET_COMMAND,
+        PACKET_COMMAND2,
+        PACKET_COMMAND3,
+        PACKET_COMMAND4,
+        PACKET_CONTROL,
+    ],
+    "11": [
+        PACKET_DEVICE_CREATE,
+    ],
+    "20": [
+        PACKET_VERSION,
+        PACKET_RESPONSE,
+        PACKET_DEVICE,
+        PACKET_DEBUG,
+        PACKET_INFO,
+        PACKET_RFDEBUGN,
+        PACKET_RFUDEBUGN,
+        PACKET_RFDEBUGF,
+        PACKET_RFUDEBUGF,
+        PACKET_QRFDEBUGN,
+        PACKET_QRFDEBUGF,
+        PACKET_GPIOOFF,
+        PACKET_GPIOON,
+        PACKET_DEBUGRTS,
+    ],
+}
+
+
+# literal and sequence prefix shared by all packet formats of a node header
+PACKET_PREFIXES = {
+    "10": "10" + DELIM,
+    "11": DELIM.join(["11", "20", SEQUENCE, ""]),
+    "20": DELIM.join(["20", SEQUENCE, ""]),
+}
+
+
+def packet_formats_re(formats: List[str], prefix: str = "") -> str:
+    """Combine packet formats into one anchored validation regex.
+
+    The `prefix` shared by all formats is matched once, not for every alternative.
+    """
+    if not all(f.startswith(prefix) for f in formats):
+        raise ValueError("prefix %r not shared by all packet formats" % prefix)
+    start = len(prefix)
+    return "^" + prefix + "(" + "|".join(f[start:] for f in formats) + ");$"
+
+
+PACKET_HEADER_RE = packet_formats_re(
+    [f for formats in PACKET_FORMATS.values() for f in formats]
 )
 packet_header_re = re.compile(PACKET_HEADER_RE)
 
+# dispatch on node header so only the formats for that header are tried
+# note: alternative engines were measured against the re module for packet
+# sized input, their per call overhead outweighs faster matching:
+# google-re2 (DFA) ~10x slower, pcre2 (JIT) and regex ~3x slower
+packet_header_res = {
+    node + DELIM: re.compile(packet_formats_re(formats, PACKET_PREFIXES[node]))
+    for node, formats in PACKET_FORMATS.items()
+}
+# same for raw bytes, to validate data before decoding it
+packet_header_res_bytes = {
+    (node + DELIM).encode(): re.compile(
+        packet_formats_re(formats, PACKET_PREFIXES[node]).encode()
+    )
+    for node, formats in PACKET_FORMATS.items()
+}
+
+# key=value pair in (lowercased) packet attributes, value may contain '='
+ATTR_RE = r"([^;=]+)=([^;]*)"
+attr_re = re.compile(ATTR_RE)
+
 PacketType = Dict[str, Any]
 
 
@@ -114,84 +174,106 @@ class PacketHeader(Enum):
     gateway = "20"
 
 
-PACKET_FIELDS = {
-    "awinsp": "average_windspeed",
-    "baro": "barometric_pressure",
-    "bat": "battery",
-    "bforecast": "weather_forecast",
-    "chime": "doorbell_melody",
-    "cmd": "command",
-    "co2": "co2_air_quality",
-    "current": "current_phase_1",
-    "current2": "current_phase_2",
-    "current3": "current_phase_3",
-    "dist": "distance",
-    "fw": "firmware",
-    "hstatus": "humidity_status",
-    "hum": "humidity",
-    "hw": "hardware",
-    "kwatt": "kilowatt",
-    "lux": "light_intensity",
-    "meter": "meter_value",
-    "rain": "total_rain",
-    "rainrate": "rain_rate",
-    "raintot": "total_rain",
-    "rev": "revision",
-    "sound": "noise_level",
-    "temp": "temperature",
-    "uv": "uv_intensity",
-    "ver": "version",
-    "volt": "voltage",
-    "watt": "watt",
-    "winchl": "windchill",
-    "wind": "windspeed",
-    "windir": "winddirection",
-    "wings": "windgusts",
-    "winsp": "windspeed",
-    "wintmp": "windtemp",
-}
+# node header to name lookup, avoids Enum call overhead in the decode path
+NODE_NAMES = {header.value: header.name for header in PacketHeader}
+
+# decoded form of the most common packet, the gateway acknowledging a command
+# 20;D3;OK;
+ACK_PACKET = {"node": PacketHeader.gateway.name, "protocol": UNKNOWN, "ok": True}
+
 
-UNITS = {
-    "awinsp": "km/h",
-    # depends on sensor
-    "baro": None,
-    "bat": None,
-    "bforecast": None,
-    "chime": None,
-    "cmd": None,
-    "co2": None,
-    "current": "A",
-    "current2": "A",
-    "current3": "A",
-    # depends on sensor
-    "dist": None,
-    "fw": None,
-    "hstatus": None,
-    "hum": "%",
-    "hw": None,
-    "kwatt": "kW",
-    "lux": "lux",
-    # depends on sensor
-    "meter": None,
-    "rain": "mm",
-    "rainrate": "mm",
-    "raintot": "mm",
-    "rev": None,
-    # unknown, might be dB?
-    "sound": None,
-    # might be °F, but default to something
-    "temp": "°C",
-    "uv": None,
-    "ver": None,
-    "volt": "v",
-    "watt": "w",
-    "winchl": "°C",
-    "wind": "km/h",
-    "windir": "°",
-    "wings": "km/h",
-    "winsp": "km/h",
-    "wintmp": "°C",
+# read-only, ATTRIBUTES below is derived from these tables once at import
+PACKET_FIELDS = MappingProxyType(
+    {
+        "awinsp": "average_windspeed",
+        "baro": "barometric_pressure",
+        "bat": "battery",
+        "bforecast": "weather_forecast",
+        "chime": "doorbell_melody",
+        "cmd": "command",
+        "co2": "co2_air_quality",
+        "current": "current_phase_1",
+        "current2": "current_phase_2",
+        "current3": "current_phase_3",
+        "dist": "distance",
+        "fw": "firmware",
+        "hstatus": "humidity_status",
+        "hum": "humidity",
+        "hw": "hardware",
+        "kwatt": "kilowatt",
+        "lux": "light_intensity",
+        "meter": "meter_value",
+        "rain": "total_rain",
+        "rainrate": "rain_rate",
+        "raintot": "total_rain",
+        "rev": "revision",
+        "sound": "noise_level",
+        "temp": "temperature",
+        "uv": "uv_intensity",
+        "ver": "version",
+        "volt": "voltage",
+        "watt": "watt",
+        "winchl": "windchill",
+        "wind": "windspeed",
+        "windir": "winddirection",
+        "wings": "windgusts",
+        "winsp": "windspeed",
+        "wintmp": "windtemp",
+    }
+)
+
+# reverse lookup of field name to abbreviation, alphabetically first
+# abbreviation wins for fields with multiple abbreviations (eg: total_rain)
+FIELD_ABBREV = {
+    v: k
+    for k, v in sorted(PACKET_FIELDS.items(), key=lambda x: (x[1], x[0]), reverse=True)
 }
+# packet key holding the unit for each field
+UNIT_FIELDS = {name: name + "_unit" for name in FIELD_ABBREV}
+
+UNITS = MappingProxyType(
+    {
+        "awinsp": "km/h",
+        # depends on sensor
+        "baro": None,
+        "bat": None,
+        "bforecast": None,
+        "chime": None,
+        "cmd": None,
+        "co2": None,
+        "current": "A",
+        "current2": "A",
+        "current3": "A",
+        # depends on sensor
+        "dist": None,
+        "fw": None,
+        "hstatus": None,
+        "hum": "%",
+        "hw": None,
+        "kwatt": "kW",
+        "lux": "lux",
+        # depends on sensor
+        "meter": None,
+        "rain": "mm",
+        "rainrate": "mm",
+        "raintot": "mm",
+        "rev": None,
+        # unknown, might be dB?
+        "sound": None,
+        # might be °F, but default to something
+        "temp": "°C",
+        "uv": None,
+        "ver": None,
+        "volt": "v",
+        "watt": "w",
+        "winchl": "°C",
+        "wind": "km/h",
+        "windir": "°",
+        "wings": "km/h",
+        "winsp": "km/h",
+        "wintmp": "°C",
+    }
+)
 
 HSTATUS_LOOKUP = {
     "0": "normal",
@@ -210,50 +292,84 @@ BFORECAST_LOOKUP = {
 
 def signed_to_float(hex: str) -> float:
     """Convert signed hexadecimal to floating value."""
-    if int(hex, 16) & 0x8000:
-        return -(int(hex, 16) & 0x7FFF) / 10
+    value = int(hex, 16)
+    if value & 0x8000:
+        return -(value & 0x7FFF) / 10
     else:
-        return int(hex, 16) / 10
-
-
-VALUE_TRANSLATION = cast(
-    Dict[str, Callable[[str], str]],
-    {
-        "awinsp": lambda hex: int(hex, 16) / 10,
-        "baro": lambda hex: int(hex, 16),
-        "bforecast": lambda x: BFORECAST_LOOKUP.get(x, "Unknown"),
-        "chime": int,
-        "co2": int,
-        "current": int,
-        "current2": int,
-        "current3": int,
-        "dist": int,
-        "hstatus": lambda x: HSTATUS_LOOKUP.get(x, "Unknown"),
-        "hum": int,
-        "kwatt": lambda hex: int(hex, 16),
-        "lux": lambda hex: int(hex, 16),
-        "meter": int,
-        "rain": lambda hex: int(hex, 16) / 10,
-        "rainrate": lambda hex: int(hex, 16) / 10,
-        "raintot": lambda hex: int(hex, 16) / 10,
-        "sound": int,
-        "temp": signed_to_float,
-        "uv": lambda hex: int(hex, 16),
-        "volt": int,
-        "watt": lambda hex: int(hex, 16),
-        "winchl": signed_to_float,
-        "windir": lambda windir: int(windir) * 22.5,
-        "wings": lambda hex: int(hex, 16) / 10,
-        "winsp": lambda hex: int(hex, 16) / 10,
-        "wintmp": signed_to_float,
-    },
-)
+        return value / 10
+
+
+def unsigned_to_float(hex: str) -> float:
+    """Convert unsigned hexadecimal to floating value."""
+    return int(hex, 16) / 10
+
+
+def hex_to_int(hex: str) -> int:
+    """Convert hexadecimal to integer value."""
+    return int(hex, 16)
+
+
+ValueTranslation = Callable[[str], Union[int, float, str]]
+
+_VALUE_TRANSLATION = {
+    "awinsp": unsigned_to_float,
+    "baro": hex_to_int,
+    "bforecast": lambda x: BFORECAST_LOOKUP.get(x, "Unknown"),
+    "chime": int,
+    "co2": int,
+    "current": int,
+    "current2": int,
+    "current3": int,
+    "dist": int,
+    "hstatus": lambda x: HSTATUS_LOOKUP.get(x, "Unknown"),
+    "hum": int,
+    "kwatt": hex_to_int,
+    "lux": hex_to_int,
+    "meter": int,
+    "rain": unsigned_to_float,
+    "rainrate": unsigned_to_float,
+    "raintot": unsigned_to_float,
+    "sound": int,
+    "temp": signed_to_float,
+    "uv": hex_to_int,
+    "volt": int,
+    "watt": hex_to_int,
+    "winchl": signed_to_float,
+    "windir": lambda windir: int(windir) * 22.5,
+    "wings": unsigned_to_float,
+    "winsp": unsigned_to_float,
+    "wintmp": signed_to_float,
+}  # type: Dict[str, ValueTranslation]
+VALUE_TRANSLATION = MappingProxyType(_VALUE_TRANSLATION)
+
+# all metadata for known attributes in one lookup:
+# (value translation, field name, unit field name, unit)
+ATTRIBUTES = {
+    key: (
+        VALUE_TRANSLATION.get(key),
+        PACKET_FIELDS.get(key, key),
+        PACKET_FIELDS.get(key, key) + "_unit",
+        UNITS.get(key),
+    )
+    for key in set(PACKET_FIELDS) | set(VALUE_TRANSLATION) | set(UNITS)
+}  # type: Dict[str, Tuple[Optional[ValueTranslation], str, str, Optional[str]]]
 
 
 BANNER_RE = (
     r"(?P<hardware>[a-zA-Z\s]+) - (?P<firmware>[a-zA-Z\s]+) "
     r"V(?P<version>[0-9\.]+) - R(?P<revision>[0-9\.]+)"
 )
+banner_re = re.compile(BANNER_RE)
+
+
+# offset of the rolling packet counter for node headers that have one, the
+# counter is left out of cache keys so repeated packets are actually cache hits
+SEQUENCE_OFFSETS = {"20;": 3, "11;": 6}
+SEQUENCE_OFFSETS_BYTES = {k.encode(): v for k, v in SEQUENCE_OFFSETS.items()}
+SEQUENCE_CHARS = frozenset(string.digits + string.ascii_letters)
+SEQUENCE_CHARS_BYTES = frozenset(ord(c) for c in SEQUENCE_CHARS)
+# placeholder for a debug packet's counter, which is not part of the decode cache key
+SEQUENCE_MARKER = object()
 
 
 def valid_packet(packet: str) -> bool:
@@ -264,11 +380,57 @@ def valid_packet(packet: str) -> bool:
     >>> # invalid packet due to leftovers in serial buffer
     >>> valid_packet('20;00;N20;00;Nodo RadioFrequencyLink - RFLink Gateway V1.1 - R45')
     False
+    >>> # unknown node header
+    >>> valid_packet('30;D3;OK;')
+    False
+    >>> # invalid packet counter
+    >>> valid_packet('20;+1;OK;')
+    False
     """
-    return bool(packet_header_re.match(packet))
+    offset = SEQUENCE_OFFSETS.get(packet[:3])
+    if offset is not None:
+        end = offset + 2
+        if len(packet) <= end or not SEQUENCE_CHARS.issuperset(packet[offset:end]):
+            return False
+        # validate with a fixed counter instead
+        packet = packet[:offset] + "00" + packet[end:]
+    return _valid_packet(packet)
 
 
-def decode_packet(packet: str) -> PacketType:
+@lru_cache(maxsize=PACKET_CACHE_SIZE)
+def _valid_packet(packet: str) -> bool:
+    """Verify if packet (with its counter replaced) is valid."""
+    regex = packet_header_res.get(packet[:3])
+    return bool(regex and regex.match(packet))
+
+
+def valid_packet_bytes(packet: bytes) -> bool:
+    """Verify if raw (undecoded) packet is valid.
+
+    >>> valid_packet_bytes(b'20;08;UPM/Esic;ID=1003;RAIN=0010;BAT=OK;')
+    True
+    >>> valid_packet_bytes(b'20;00;N20;00;Nodo RadioFrequencyLink - RFLink Gateway V1.1 - R45')
+    False
+    """
+    offset = SEQUENCE_OFFSETS_BYTES.get(packet[:3])
+    if offset is not None:
+        end = offset + 2
+        if len(packet) <= end or not SEQUENCE_CHARS_BYTES.issuperset(
+            packet[offset:end]
+        ):
+            return False
+        packet = packet[:offset] + b"00" + packet[end:]
+    return _valid_packet_bytes(packet)
+
+
+@lru_cache(maxsize=PACKET_CACHE_SIZE)
+def _valid_packet_bytes(packet: bytes) -> bool:
+    """Verify if raw packet (with its counter replaced) is valid."""
+    regex = packet_header_res_bytes.get(packet[:3])
+    return bool(regex and regex.match(packet))
+
+
+def decode_packet(packet: Union[str, bytes]) -> PacketType:
     """Break packet down into primitives, and do basic interpretation.
 
     >>> decode_packet('20;06;Kaku;ID=41;SWITCH=1;CMD=ON;') == {
@@ -280,9 +442,36 @@ def decode_packet(packet: str) -> PacketType:
     ... }
     True
     """
-    node_id, _, protocol, attrs = packet.split(DELIM, 3)
+    if isinstance(packet, bytes):
+        packet = packet.decode()
+    # return a fresh dict every time so callers are free to modify it
+    if len(packet) == 9 and packet.startswith("20;") and packet.endswith(";OK;"):
+        return dict(ACK_PACKET)
+    node_id, _, rest = packet.partition(DELIM)
+    # the second field (packet counter for gateway packets) is not decoded,
+    # leave it out of the cache key
+    sequence, _, rest = rest.partition(DELIM)
+    if DELIM not in rest:
+        raise ValueError("not enough fields in packet: %s" % packet)
+    data = dict(_decode_packet(node_id, rest))
+    if data.get("tm") is SEQUENCE_MARKER:
+        data["tm"] = sequence
+    return data
+
+
+@lru_cache(maxsize=PACKET_CACHE_SIZE)
+def _decode_packet(node_id: str, rest: str) -> Tuple[Tuple[str, Any], ...]:
+    """Decode packet into (immutable) items, cached as gateways often repeat packets.
+
+    `rest` is the packet without its node header and counter, a debug packet
+    gets SEQUENCE_MARKER as `tm` which decode_packet replaces with the counter.
+    """
+    protocol, _, attrs = rest.partition(DELIM)
+
+    data = cast(PacketType, {"node": NODE_NAMES[node_id]})
 
-    data = cast(PacketType, {"node": PacketHeader(node_id).name})
+    # lowercased once, both debug and regular packets need it
+    protocol_lower = protocol.lower()
 
     # make exception for version response
     data["protocol"] = UNKNOWN
@@ -294,15 +483,15 @@ def decode_packet(packet: str) -> PacketType:
         data.update(parse_banner(protocol))
 
     elif protocol == "PONG":
-        data["ping"] = protocol.lower()
+        data["ping"] = "pong"
 
     # debug response
-    elif protocol.lower() == "debug":
-        data["protocol"] = protocol.lower()
+    elif protocol_lower == "debug":
+        data["protocol"] = protocol_lower
         if attrs.startswith("RTS P1"):
             data["rts_p1"] = attrs.strip(DELIM).split(DELIM)[1]
         else:
-            data["tm"] = packet[3:5]
+            data["tm"] = SEQUENCE_MARKER
 
     # failure response
     elif protocol == "CMD UNKNOWN":
@@ -319,41 +508,63 @@ def decode_packet(packet: str) -> PacketType:
 
     # its a regular packet
     else:
-        data["protocol"] = protocol.lower()
+        data["protocol"] = protocol_lower
 
     # convert key=value pairs where needed
-    for attr in filter(None, attrs.strip(DELIM).split(DELIM)):
-        if "=" not in attr:
+    for key, value in attr_re.findall(attrs.lower()):
+        attribute = ATTRIBUTES.get(key)
+        if attribute is None:
+            # unknown attribute, pass on as is
+            data[key] = value
             continue
-        key, value = attr.lower().split("=", 1)
-        if key in VALUE_TRANSLATION:
+        translation, name, unit_name, unit = attribute
+        if translation:
             try:
-                value = VALUE_TRANSLATION[key](value)
+                data[name] = translation(value)
             except ValueError:
                 log.warning(
                     "Could not convert attr '%s' value '%s' to expected type '%s'",
                     key,
                     value,
-                    VALUE_TRANSLATION[key].__name__,
+                    translation.__name__,
                 )
                 continue
-        name = PACKET_FIELDS.get(key, key)
-        data[name] = value
-        unit = UNITS.get(key, None)
+        else:
+            data[name] = value
 
         if unit:
-            data[name + "_unit"] = unit
+            data[unit_name] = unit
 
     # correct KaKu device address
     if data.get("protocol", "") == "kaku" and len(data["id"]) != 6:
         data["id"] = "0000" + data["id"]
 
-    return data
+    return tuple(data.items())
+
+
+def iter_packet_spans(buf: bytes) -> Iterator[Tuple[int, int]]:
+    r"""Find the (start, end) positions of every complete line in a buffer.
+
+    Does not copy the lines, so large captures (eg: a mmapped log_all file)
+    can be scanned and only the packets of interest sliced and decoded.
+    Empty lines and a trailing incomplete line are skipped.
+
+    >>> buf = b'20;00;Nodo RadioFrequencyLink;\r\n\r\n20;01;OK;\r\n20;02;'
+    >>> [buf[start:end] for start, end in iter_packet_spans(buf)]
+    [b'20;00;Nodo RadioFrequencyLink;', b'20;01;OK;']
+    """
+    start = 0
+    end = buf.find(b"\r\n")
+    while end >= 0:
+        if end > start:
+            yield start, end
+        start = end + 2
+        end = buf.find(b"\r\n", start)
 
 
 def parse_banner(banner: str) -> Dict[str, str]:
     """Extract hardware/firmware name and version from banner."""
-    match = re.match(BANNER_RE, banner)
+    match = banner_re.match(banner)
     return match.groupdict() if match else {}
 
 
@@ -375,7 +586,13 @@ def encode_packet(packet: PacketType) -> str:
     elif packet["protocol"] == "qrfdebug":
         return "10;QRFDEBUG=%s;" % packet["command"]
     else:
-        return SWITCH_COMMAND_TEMPLATE.format(node=PacketHeader.master.value, **packet)
+        # same as SWITCH_COMMAND_TEMPLATE, without parsing the template every call
+        return "10;%s;%s;%s;%s;" % (
+            packet["protocol"],
+            packet["id"],
+            packet["switch"],
+            packet["command"],
+        )
 
 
 # create lookup table of not easy to reverse protocol names
@@ -398,19 +615,31 @@ translate_protocols = [
 ]
 
 
-class TranslationsDict(DefaultDict[str, str]):
-    """Generate translations for Rflink protocols to serializable names."""
+class SerializableCharacters(Dict[int, Optional[int]]):
+    """Character table for `str.translate` deleting unserializable characters."""
+
+    def __missing__(self, key: int) -> None:
+        """Delete every character not explicitly allowed."""
+        return None
 
-    def __missing__(self, key: str) -> str:
-        """If translation does not exist yet add it and its reverse."""
-        value = re.sub(r"[^a-z0-9_]+", "", key.lower())
-        self[key.lower()] = value
-        self[value] = key.lower()
-        return value
+
+serializable_characters = SerializableCharacters(
+    (ord(c), ord(c)) for c in string.ascii_lowercase + string.digits + "_"
+)
 
 
-protocol_translations = TranslationsDict(None)
-[protocol_translations[protocol] for protocol in translate_protocols]
+def serialize_protocol(protocol: str) -> str:
+    """Translate Rflink protocol name into a serializable name."""
+    return protocol.lower().translate(serializable_characters)
+
+
+# precomputed translations of not easy to reverse protocol names
+serialized_protocols = {
+    protocol.lower(): serialize_protocol(protocol) for protocol in translate_protocols
+}
+deserialized_protocols = {
+    value: key for key, value in serialized_protocols.items()
+}  # type: Dict[str, str]
 
 
 def serialize_packet_id(packet: PacketType) -> str:
@@ -441,14 +670,25 @@ def serialize_packet_id(packet: PacketType) -> str:
     'alectov4_000080_0'
     """
     # translate protocol into something reversible
-    protocol = protocol_translations[packet["protocol"]]
+    name = packet["protocol"].lower()
+    protocol = serialized_protocols.get(name)
+    if protocol is None:
+        protocol = serialize_protocol(name)
+        if protocol != name:
+            # remember lossy translations of protocols missing from the
+            # table so commands for them can still be deserialized, only
+            # grows with the number of such protocols known to the gateway
+            deserialized_protocols.setdefault(protocol, name)
 
     if protocol == UNKNOWN:
         protocol = "rflink"
 
-    return "_".join(
-        filter(None, [protocol, packet.get("id", None), packet.get("switch", None)])
-    )
+    packet_id = protocol
+    for field in (packet.get("id"), packet.get("switch")):
+        # empty fields, protocol included, are left out with their separator
+        if field:
+            packet_id = packet_id + PACKET_ID_SEP + field if packet_id else field
+    return packet_id
 
 
 def deserialize_packet_id(packet_id: str) -> Dict[str, str]:
@@ -482,26 +722,35 @@ def deserialize_packet_id(packet_id: str) -> Dict[str, str]:
     if packet_id == "rflink":
         return {"protocol": UNKNOWN}
 
-    # Protocol names can contain underscores themselves (like: dooya_v4), using rsplit to
-    # prevent parsing issues with these kind of packets.
-    protocol, *id_switch = packet_id.rsplit(PACKET_ID_SEP, 2)
+    # Protocol names can contain underscores themselves (like: dooya_v4), splitting from
+    # the right to prevent parsing issues with these kind of packets.
+    device_id = switch = None  # type: Optional[str]
+    rest, sep, last = packet_id.rpartition(PACKET_ID_SEP)
+    if not sep:
+        protocol = packet_id
+    else:
+        protocol, sep, device_id = rest.rpartition(PACKET_ID_SEP)
+        if sep:
+            switch = last
+        else:
+            protocol, device_id = rest, last
 
     packet_identifiers = {
         # lookup the reverse translation of the protocol in the translation
         # table, fallback to protocol. If this is an unserializable protocol
         # name, it has not been serialized before and is not in the
         # translate_protocols table this will result in an invalid command.
-        "protocol": protocol_translations.get(protocol, protocol),
+        "protocol": deserialized_protocols.get(protocol, protocol),
     }
-    if id_switch:
-        packet_identifiers["id"] = id_switch[0]
-    if len(id_switch) > 1:
-        packet_identifiers["switch"] = id_switch[1]
+    if device_id is not None:
+        packet_identifiers["id"] = device_id
+    if switch is not None:
+        packet_identifiers["switch"] = switch
 
     return packet_identifiers
 
 
-def packet_events(packet: PacketType) -> Generator[PacketType, None, None]:
+def packet_events(packet: PacketType) -> List[PacketType]:
     """Return list of all events in the packet.
 
     >>> x = list(packet_events({
@@ -532,41 +781,45 @@ def packet_events(packet: PacketType) -> Generator[PacketType, None, None]:
     ... }))
     >>> assert {'id': 'newkaku_000001_01', 'command': 'on'} in y
     """
-    field_abbrev = {
-        v: k
-        for k, v in sorted(
-            PACKET_FIELDS.items(), key=lambda x: (x[1], x[0]), reverse=True
-        )
-    }
-
     packet_id = serialize_packet_id(packet)
-    events = {f: v for f, v in packet.items() if f in field_abbrev}
-    if "command" in events or "version" in events:
+    if "command" in packet or "version" in packet:
         # switch events only have one event in each packet
-        yield dict(id=packet_id, **events)
-    else:
-        if packet_id == "debug":
-            yield {
+        return [
+            dict(id=packet_id, **{f: v for f, v in packet.items() if f in FIELD_ABBREV})
+        ]
+
+    if packet_id == "debug":
+        return [
+            {
                 "id": "raw",
                 "value": packet.get("pulses(usec)"),
                 "tm": packet.get("tm"),
                 "pulses": packet.get("pulses"),
             }
-        else:
-            # sensors can have multiple
-            for sensor, value in events.items():
-                unit = packet.get(sensor + "_unit", None)
-                yield {
-                    "id": packet_id + PACKET_ID_SEP + field_abbrev[sensor],
-                    "sensor": sensor,
-                    "value": value,
-                    "unit": unit,
-                }
-
-            if packet_id != "rflink":
-                yield {
-                    "id": packet_id + PACKET_ID_SEP + "update_time",
-                    "sensor": "update_time",
-                    "value": round(time.time()),
-                    "unit": "s",
-                }
+        ]
+
+    # sensors can have multiple
+    events = []
+    for sensor, value in packet.items():
+        abbrev = FIELD_ABBREV.get(sensor)
+        if abbrev is None:
+            continue
+        events.append(
+            {
+                "id": packet_id + PACKET_ID_SEP + abbrev,
+                "sensor": sensor,
+                "value": value,
+                "unit": packet.get(UNIT_FIELDS[sensor]),
+            }
+        )
+
+    if packet_id != "rflink":
+        events.append(
+            {
+                "id": packet_id + PACKET_ID_SEP + "update_time",
+                "sensor": "update_time",
+                "value": round(time.time()),
+                "unit": "s",
+            }
+        )
+    return events
@@ -4,18 +4,20 @@
 # /Library/Frameworks/Python.framework/Versions/3.6//lib/python3.6/site-packages/rflink/protocol.py
 
 import asyncio
-import concurrent
 import logging
+import re
+import selectors
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from fnmatch import fnmatchcase
+from fnmatch import translate
 from functools import partial
-from typing import (
+from typing import (  # noqa: unused-import
     TYPE_CHECKING,
     Any,
     Callable,
-    Generator,
     Optional,
     Sequence,
+    TextIO,
     Tuple,
     Type,
     Union,
@@ -33,7 +35,7 @@ from .parser import (
     deserialize_packet_id,
     encode_packet,
     packet_events,
-    valid_packet,
+    valid_packet_bytes,
 )
 
 if TYPE_CHECKING:
@@ -41,11 +43,36 @@ if TYPE_CHECKING:
 
 
 log = logging.getLogger(__name__)
-rflink_log = None
+rflink_log = None  # type: Optional[TextIO]
 
 TIMEOUT = timedelta(seconds=5)
+# seconds logged packets may stay buffered before being written to the log file
+LOG_FLUSH_INTERVAL = 1.0
 DEFAULT_TCP_KEEPALIVE_INTERVAL = 20
 DEFAULT_TCP_KEEPALIVE_COUNT = 3
+TCP_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+# seconds between checks whether the serial port is still open while waiting to write
+WRITE_POLL_INTERVAL = 1.0
+
+
+def write_blocking(port: Any, data: bytes) -> None:
+    """Write all data to (non-blocking) serial port, waiting until it is writable.
+
+    serial_asyncio opens the port with write_timeout=0, in which mode pyserial
+    would retry a write to a full output buffer in a busy loop. Gives up once
+    the port is closed, so a stalled port does not block the writer forever.
+    """
+    view = memoryview(data)
+    with selectors.DefaultSelector() as selector:
+        selector.register(port.fileno(), selectors.EVENT_WRITE)
+        while view:
+            if not port.is_open:
+                log.warning("serial port closed, dropping %d bytes", len(view))
+                return
+            if not selector.select(WRITE_POLL_INTERVAL):
+                continue
+            written = port.write(view)
+            view = view[written:]
 
 
 class ProtocolBase(asyncio.Protocol):
@@ -59,30 +86,50 @@ class ProtocolBase(asyncio.Protocol):
         loop: Optional[asyncio.AbstractEventLoop] = None,
         disconnect_callback: Optional[Callable[[Optional[Exception]], None]] = None,
         keepalive: Optional[int] = None,
+        threaded_writes: bool = False,
+        keepalive_interval: int = DEFAULT_TCP_KEEPALIVE_INTERVAL,
+        keepalive_count: int = DEFAULT_TCP_KEEPALIVE_COUNT,
         **kwargs: Any
     ) -> None:
-        """Initialize class."""
+        """Initialize class.
+
+        threaded_writes: perform blocking writes to serial ports from a
+        dedicated thread instead of the event loop (POSIX only).
+        keepalive_interval/keepalive_count: TCP keepalive probe interval
+        (seconds) and count, applied when keepalive is enabled.
+        """
         if loop:
             self.loop = loop
         else:
             self.loop = asyncio.get_event_loop()
         self.packet = ""
-        self.buffer = ""
+        # incoming data not yet assembled into complete lines
+        self.buffer = bytearray()
+        self._write_executor = None  # type: Optional[ThreadPoolExecutor]
+        if threaded_writes:
+            self._write_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="rflink-writer"
+            )
         self.packet_callback = None  # type: Optional[Callable[[PacketType], None]]
         self.disconnect_callback = disconnect_callback
         self.keepalive = keepalive
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
 
     def connection_made(self, transport: asyncio.BaseTransport) -> None:
         """Just logging for now."""
         self.transport = transport
         log.debug("connected")
         sock = transport.get_extra_info("socket")
-        if self.keepalive is not None and socket is not None:
+        if sock is None or sock.family not in TCP_FAMILIES:
+            # not a TCP connection (eg: serial)
+            return
+        if self.keepalive is not None:
             log.debug(
                 "applying TCP KEEPALIVE settings: IDLE={}/INTVL={}/CNT={}".format(
                     self.keepalive,
-                    DEFAULT_TCP_KEEPALIVE_INTERVAL,
-                    DEFAULT_TCP_KEEPALIVE_COUNT,
+                    self.keepalive_interval,
+                    self.keepalive_count,
                 )
             )
             if hasattr(socket, "SO_KEEPALIVE"):
@@ -93,33 +140,45 @@ class ProtocolBase(asyncio.Protocol):
                 sock.setsockopt(
                     socket.IPPROTO_TCP,
                     socket.TCP_KEEPINTVL,
-                    DEFAULT_TCP_KEEPALIVE_INTERVAL,
+                    self.keepalive_interval,
                 )
             if hasattr(socket, "TCP_KEEPCNT"):
                 sock.setsockopt(
-                    socket.IPPROTO_TCP, socket.TCP_KEEPCNT, DEFAULT_TCP_KEEPALIVE_COUNT
+                    socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepalive_count
                 )
 
     def data_received(self, data: bytes) -> None:
         """Add incoming data to buffer."""
-        try:
-            decoded_data = data.decode()
-        except UnicodeDecodeError:
-            invalid_data = data.decode(errors="replace")
-            log.warning("Error during decode of data, invalid data: %s", invalid_data)
-        else:
-            log.debug("received data: %s", decoded_data.strip())
-            self.buffer += decoded_data
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("received data: %s", data.decode(errors="replace").strip())
+        self.buffer += data
+        # only new data can complete a line (a split line ending included),
+        # avoids rescanning the buffer for chunks without any line ending
+        if b"\n" in data:
             self.handle_lines()
 
     def handle_lines(self) -> None:
         """Assemble incoming data into per-line packets."""
-        while "\r\n" in self.buffer:
-            line, self.buffer = self.buffer.split("\r\n", 1)
-            if valid_packet(line):
-                self.handle_raw_packet(line)
+        end = self.buffer.rfind(b"\r\n")
+        if end < 0:
+            return
+        # take all complete lines at once, leaving the incomplete remainder
+        lines = bytes(memoryview(self.buffer)[:end]).split(b"\r\n")
+        del self.buffer[: end + 2]
+        for line in lines:
+            # validate before decoding, so invalid data is never decoded
+            if not valid_packet_bytes(line):
+                log.warning("dropping invalid data: %s", line.decode(errors="replace"))
+                continue
+            try:
+                decoded_line = line.decode()
+            except UnicodeDecodeError:
+                invalid_data = line.decode(errors="replace")
+                log.warning(
+                    "Error during decode of data, invalid data: %s", invalid_data
+                )
             else:
-                log.warning("dropping invalid data: %s", line)
+                self.handle_raw_packet(decoded_line)
 
     def handle_raw_packet(self, raw_packet: str) -> None:
         """Handle one raw incoming packet."""
@@ -127,16 +186,31 @@ class ProtocolBase(asyncio.Protocol):
 
     def send_raw_packet(self, packet: str) -> None:
         """Encode and put packet string onto write buffer."""
-        data = packet + "\r\n"
-        log.debug("writing data: %s", repr(data))
+        data = packet.encode() + b"\r\n"
+        log.debug("writing packet: %s", packet)
+        port = self.transport.get_extra_info("serial")
+        if self._write_executor and port is not None:
+            # single worker thread keeps writes in order
+            future = self.loop.run_in_executor(
+                self._write_executor, write_blocking, port, data
+            )
+            future.add_done_callback(self._write_done)
+            return
         # type ignore: transport from create_connection is documented to be
         # implementation specific bidirectional, even though typed as
         # BaseTransport
-        self.transport.write(data.encode())  # type: ignore
+        self.transport.write(data)  # type: ignore
+
+    def _write_done(self, future: "asyncio.Future[None]") -> None:
+        """Log errors of writes done from the writer thread."""
+        if not future.cancelled() and future.exception():
+            log.error("failed to write to serial port", exc_info=future.exception())
 
     def log_all(self, file: Optional[str]) -> None:
         """Log all data received from RFLink to file."""
         global rflink_log
+        if rflink_log:
+            rflink_log.close()
         if file is None:
             rflink_log = None
         else:
@@ -145,6 +219,10 @@ class ProtocolBase(asyncio.Protocol):
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
         """Log when connection is closed, if needed call callback."""
+        if rflink_log:
+            rflink_log.flush()
+        if self._write_executor:
+            self._write_executor.shutdown(wait=False)
         if exc:
             log.exception("disconnected due to exception")
         else:
@@ -170,17 +248,28 @@ class PacketHandling(ProtocolBase):
         super().__init__(*args, **kwargs)
         if packet_callback:
             self.packet_callback = packet_callback
+        self._log_flush = None  # type: Optional[asyncio.TimerHandle]
+
+    def _flush_log(self) -> None:
+        """Write out packets buffered for the log file."""
+        self._log_flush = None
+        if rflink_log:
+            rflink_log.flush()
 
     def handle_raw_packet(self, raw_packet: str) -> None:
         """Parse raw packet string into packet dict."""
         log.debug("got packet: %s", raw_packet)
         if rflink_log:
             print(raw_packet, file=rflink_log)
-            rflink_log.flush()
+            # flush periodically instead of every packet
+            if self._log_flush is None:
+                self._log_flush = self.loop.call_later(
+                    LOG_FLUSH_INTERVAL, self._flush_log
+                )
         packet = None  # type: Optional[PacketType]
         try:
             packet = decode_packet(raw_packet)
-        except BaseException:
+        except Exception:
             log.exception("failed to parse packet data: %s", raw_packet)
 
         log.debug("decoded packet: %s", packet)
@@ -211,12 +300,16 @@ class PacketHandling(ProtocolBase):
         """Concat fields and send packet to gateway."""
         self.send_raw_packet(encode_packet(fields))
 
-    def send_command(self, device_id: str, action: str) -> None:
-        """Send device command to rflink gateway."""
+    def encode_command(self, device_id: str, action: str) -> str:
+        """Encode device command into packet string for rflink gateway."""
         command = deserialize_packet_id(device_id)
         command["command"] = action
-        log.debug("sending command: %s", command)
-        self.send_packet(command)
+        log.debug("encoding command: %s", command)
+        return encode_packet(command)
+
+    def send_command(self, device_id: str, action: str) -> None:
+        """Send device command to rflink gateway."""
+        self.send_raw_packet(self.encode_command(device_id, action))
 
 
 class CommandSerialization(PacketHandling):
@@ -232,39 +325,37 @@ class CommandSerialization(PacketHandling):
         super().__init__(*args, **kwargs)
         if packet_callback:
             self.packet_callback = packet_callback
-        self._command_ack = asyncio.Event()
+        # resolved with the response to the command currently being sent
+        self._pending_ack = None  # type: Optional[asyncio.Future[PacketType]]
         self._ready_to_send = asyncio.Lock()
 
     def handle_response_packet(self, packet: PacketType) -> None:
         """Handle response packet."""
-        self._last_ack = packet
-        self._command_ack.set()
+        pending_ack = self._pending_ack
+        if pending_ack and not pending_ack.done():
+            pending_ack.set_result(packet)
+        else:
+            log.debug("unexpected command response: %s", packet)
 
-    async def send_command_ack(
-        self, device_id: str, action: str
-    ) -> Generator[Any, None, Optional[bool]]:
+    async def send_command_ack(self, device_id: str, action: str) -> Optional[bool]:
         """Send command, wait for gateway to repond with acknowledgment."""
+        # encode before waiting for earlier commands, invalid ones fail right away
+        packet = self.encode_command(device_id, action)
         # serialize commands
-        await self._ready_to_send.acquire()
-        acknowledgement = None
-        try:
-            self._command_ack.clear()
-            self.send_command(device_id, action)
+        async with self._ready_to_send:
+            self._pending_ack = self.loop.create_future()
+            self.send_raw_packet(packet)
 
             log.debug("waiting for acknowledgement")
             try:
-                await asyncio.wait_for(self._command_ack.wait(), TIMEOUT.seconds)
-                log.debug("packet acknowledged")
-            except concurrent.futures._base.TimeoutError:
-                acknowledgement = False
+                ack = await asyncio.wait_for(self._pending_ack, TIMEOUT.seconds)
+            except asyncio.TimeoutError:
                 log.warning("acknowledge timeout")
-            else:
-                acknowledgement = cast(bool, self._last_ack.get("ok", False))
-        finally:
-            # allow next command
-            self._ready_to_send.release()
-
-        return acknowledgement
+                return False
+            finally:
+                self._pending_ack = None
+            log.debug("packet acknowledged")
+            return cast(bool, ack.get("ok", False))
 
 
 class EventHandling(PacketHandling):
@@ -287,14 +378,17 @@ class EventHandling(PacketHandling):
         """Add eventhandling specific initialization."""
         super().__init__(*args, **kwargs)
         self.event_callback = event_callback
-        # suppress printing of packets
-        if not kwargs.get("packet_callback"):
-            self.packet_callback = lambda x: None
         if ignore:
             log.debug("ignoring: %s", ignore)
             self.ignore = ignore
         else:
             self.ignore = []
+        # all ignore wildcards combined into one (case sensitive) regex
+        self.ignore_re = (
+            re.compile("|".join(translate(i) for i in self.ignore))
+            if self.ignore
+            else None
+        )
 
     def _handle_packet(self, packet: PacketType) -> None:
         """Event specific packet handling logic.
@@ -333,7 +427,9 @@ class EventHandling(PacketHandling):
     def handle_packet(self, packet: PacketType) -> None:
         """Apply event specific handling and pass on to packet handling."""
         self._handle_packet(packet)
-        super().handle_packet(packet)
+        # only pass on to a packet callback, events replace printing of packets
+        if self.packet_callback:
+            super().handle_packet(packet)
 
     def ignore_event(self, event_id: str) -> bool:
         """Verify event id against list of events to ignore.
@@ -349,10 +445,7 @@ class EventHandling(PacketHandling):
         >>> e.ignore_event('test3_00')
         False
         """
-        for ignore in self.ignore:
-            if fnmatchcase(event_id, ignore):
-                return True
-        return False
+        return bool(self.ignore_re and self.ignore_re.match(event_id))
 
 
 class RflinkProtocol(CommandSerialization, EventHandling):
@@ -364,11 +457,9 @@ class InverterProtocol(RflinkProtocol):
 
     def handle_event(self, event: PacketType) -> None:
         """Handle incoming packet from rflink gateway."""
-        if event.get("command"):
-            if event["command"] == "on":
-                cmd = "off"
-            else:
-                cmd = "on"
+        command = event.get("command")
+        if command:
+            cmd = "off" if command == "on" else "on"
 
             task = self.send_command_ack(event["id"], cmd)
             self.loop.create_task(task)
@@ -379,11 +470,27 @@ class RepeaterProtocol(RflinkProtocol):
 
     def handle_event(self, packet: PacketType) -> None:
         """Handle incoming packet from rflink gateway."""
-        if packet.get("command"):
-            task = self.send_command_ack(packet["id"], packet["command"])
+        command = packet.get("command")
+        if command:
+            task = self.send_command_ack(packet["id"], command)
             self.loop.create_task(task)
 
 
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Create and set event loop for standalone (CLI) use, uvloop based if installed.
+
+    Libraries embedding rflink should keep using their own event loop.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
 @overload
 def create_rflink_connection(
     port: int,
@@ -396,6 +503,9 @@ def create_rflink_connection(
     disconnect_callback: Optional[Callable[[Optional[Exception]], None]] = None,
     ignore: Optional[Sequence[str]] = None,
     loop: Optional[asyncio.AbstractEventLoop] = None,
+    *,
+    keepalive_interval: int = DEFAULT_TCP_KEEPALIVE_INTERVAL,
+    keepalive_count: int = DEFAULT_TCP_KEEPALIVE_COUNT,
 ) -> "Coroutine[Any, Any, Tuple[asyncio.BaseTransport, ProtocolBase]]":
     """Create Rflink manager class, returns transport coroutine."""
     ...
@@ -413,6 +523,8 @@ def create_rflink_connection(
     disconnect_callback: Optional[Callable[[Optional[Exception]], None]] = None,
     ignore: Optional[Sequence[str]] = None,
     loop: Optional[asyncio.AbstractEventLoop] = None,
+    *,
+    threaded_writes: bool = False,
 ) -> "Coroutine[Any, Any, Tuple[asyncio.BaseTransport, ProtocolBase]]":
     """Create Rflink manager class, returns transport coroutine."""
     ...
@@ -429,6 +541,10 @@ def create_rflink_connection(
     disconnect_callback: Optional[Callable[[Optional[Exception]], None]] = None,
     ignore: Optional[Sequence[str]] = None,
     loop: Optional[asyncio.AbstractEventLoop] = None,
+    *,
+    threaded_writes: bool = False,
+    keepalive_interval: int = DEFAULT_TCP_KEEPALIVE_INTERVAL,
+    keepalive_count: int = DEFAULT_TCP_KEEPALIVE_COUNT,
 ) -> "Coroutine[Any, Any, Tuple[asyncio.BaseTransport, ProtocolBase]]":
     """Create Rflink manager class, returns transport coroutine."""
     if loop is None:
@@ -440,8 +556,12 @@ def create_rflink_connection(
         packet_callback=packet_callback,
         event_callback=event_callback,
         disconnect_callback=disconnect_callback,
-        ignore=ignore if ignore else [],
+        # frozen, every protocol instance created by the factory shares it
+        ignore=tuple(ignore) if ignore else (),
         keepalive=keepalive,
+        threaded_writes=threaded_writes,
+        keepalive_interval=keepalive_interval,
+        keepalive_count=keepalive_count,
     )
 
     # setup serial connection if no transport specified
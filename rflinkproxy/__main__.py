@@ -23,28 +23,42 @@ import sys
 from functools import partial
 from typing import Any, Callable, Dict, cast
 
-import async_timeout
 import pkg_resources
+import serial
 from docopt import docopt
 from serial_asyncio import create_serial_connection
 
 from rflink.parser import (
     DELIM,
-    PacketHeader,
+    NODE_NAMES,
     decode_packet,
     serialize_packet_id,
-    valid_packet,
+    valid_packet_bytes,
 )
-from rflink.protocol import RflinkProtocol
+from rflink.protocol import RflinkProtocol, new_event_loop
 
 log = logging.getLogger(__name__)
 
 CRLF = b"\r\n"
+DELIM_BYTES = DELIM.encode()
 DEFAULT_RECONNECT_INTERVAL = 10
 DEFAULT_SIGNAL_REPETITIONS = 1
 CONNECTION_TIMEOUT = 10
+# errors after which connecting to the gateway is retried later
+CONNECT_ERRORS = (
+    serial.serialutil.SerialException,
+    ConnectionRefusedError,
+    TimeoutError,
+    OSError,
+    asyncio.TimeoutError,
+)
+# longest line accepted from a client, commands are far shorter
+CLIENT_LINE_LIMIT = 1024
+# bytes of unsent data after which a client is considered too slow
+CLIENT_WRITE_BUFFER_LIMIT = 64 * 1024
 
-clients = []
+# connected clients, stream writer to (reader, peer)
+clients = {}
 
 
 class ProxyProtocol(RflinkProtocol):
@@ -61,8 +75,8 @@ class ProxyProtocol(RflinkProtocol):
         packet = None
         try:
             packet = decode_packet(raw_packet)
-        except BaseException:
-            log.exception("failed to parse packet: %s", packet)
+        except Exception:
+            log.exception("failed to parse packet: %s", raw_packet)
 
         log.debug("decoded packet: %s", packet)
 
@@ -70,8 +84,7 @@ class ProxyProtocol(RflinkProtocol):
             if "ok" in packet:
                 # handle response packets internally
                 log.debug("command response: %s", packet)
-                self._last_ack = packet
-                self._command_ack.set()
+                self.handle_response_packet(packet)
             elif self.raw_callback:
                 self.raw_callback(raw_packet)
         else:
@@ -92,17 +105,13 @@ def decode_tx_packet(packet: str) -> dict:
     """
     node_id, protocol, attrs = packet.split(DELIM, 2)
 
-    data = cast(Dict[str, Any], {"node": PacketHeader(node_id).name})
+    data = cast(Dict[str, Any], {"node": NODE_NAMES[node_id]})
 
     data["protocol"] = protocol.lower()
 
-    for i, attr in enumerate(filter(None, attrs.strip(DELIM).split(DELIM))):
-        if i == 0:
-            data["id"] = attr
-        if i == 1:
-            data["switch"] = attr
-        if i == 2:
-            data["command"] = attr
+    # positional fields, any beyond the command are ignored
+    fields = [attr for attr in attrs.strip(DELIM).split(DELIM) if attr]
+    data.update(zip(("id", "switch", "command"), fields))
 
     # correct KaKu device address
     if data.get("protocol", "") == "kaku" and len(data["id"]) != 6:
@@ -131,9 +140,9 @@ class RFLinkProxy:
         packet = None
         try:
             packet = decode_tx_packet(raw_packet)
-        except BaseException:
+        except Exception:
             log.exception(
-                " %s:%s: failed to parse packet: %s", peer[0], peer[1], packet
+                " %s:%s: failed to parse packet: %s", peer[0], peer[1], raw_packet
             )
 
         log.debug(" %s:%s: decoded packet: %s", peer[0], peer[1], packet)
@@ -174,29 +183,53 @@ class RFLinkProxy:
     async def client_connected_callback(self, reader, writer):
         """Handle connected client."""
         peer = writer.get_extra_info("peername")
-        clients.append((reader, writer, peer))
+        clients[writer] = (reader, peer)
         log.info("Incoming connection from: %s:%s", peer[0], peer[1])
+        # set while skipping the rest of an overlong line
+        discarding = False
         try:
             while True:
-                data = await reader.readline()
+                try:
+                    data = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    # connection closed, possibly halfway a line
+                    data = e.partial
+                except asyncio.LimitOverrunError as e:
+                    if not discarding:
+                        log.warning(" %s:%s: dropping overlong line", peer[0], peer[1])
+                    # drop the part of the line read so far, its line end
+                    # might not even have been received yet
+                    await reader.readexactly(e.consumed)
+                    discarding = True
+                    continue
                 if not data:
                     break
-                try:
-                    line = data.decode().strip()
-                except UnicodeDecodeError:
-                    line = "\x00"
+                if discarding:
+                    # remainder of the overlong line
+                    discarding = False
+                    continue
+                data = data.strip()
 
                 # Workaround for domoticz issue #2816
-                if line[-1] != DELIM:
-                    line = line + DELIM
-
-                if valid_packet(line):
-                    await self.handle_raw_tx_packet(writer, line)
-                else:
-                    log.warning(
-                        " %s:%s: dropping invalid data: '%s'", peer[0], peer[1], line
-                    )
-                    pass
+                if not data.endswith(DELIM_BYTES):
+                    data += DELIM_BYTES
+
+                # a command from a client that fails either check is dropped
+                # here instead of being forwarded to the gateway
+                if valid_packet_bytes(data):
+                    try:
+                        line = data.decode()
+                    except UnicodeDecodeError:
+                        pass
+                    else:
+                        await self.handle_raw_tx_packet(writer, line)
+                        continue
+                log.warning(
+                    " %s:%s: dropping invalid data: '%s'",
+                    peer[0],
+                    peer[1],
+                    data.decode(errors="replace"),
+                )
         except ConnectionResetError:
             pass
         except Exception as e:
@@ -204,7 +237,7 @@ class RFLinkProxy:
 
         log.info("Disconnected from: %s:%s", peer[0], peer[1])
         writer.close()
-        clients.remove((reader, writer, peer))
+        clients.pop(writer, None)
 
     def raw_callback(self, raw_packet):
         """Send data to all connected clients."""
@@ -212,9 +245,16 @@ class RFLinkProxy:
             log.info("forwarding packet %s to clients", raw_packet)
         else:
             log.debug("forwarding packet %s to clients", raw_packet)
-        writers = [i[1] for i in list(clients)]
-        for writer in writers:
-            writer.write(str(raw_packet).encode() + CRLF)
+        # encoded once, shared by all clients
+        data = raw_packet.encode() + CRLF
+        for writer, (_, peer) in clients.items():
+            if writer.transport.get_write_buffer_size() > CLIENT_WRITE_BUFFER_LIMIT:
+                # drop clients not reading their data instead of buffering forever,
+                # the client handler cleans up once the connection is lost
+                log.warning(" %s:%s: client too slow, disconnecting", peer[0], peer[1])
+                writer.transport.abort()
+                continue
+            writer.write(data)
 
     def reconnect(self, exc=None):
         """Schedule reconnect after connection has been unexpectedly lost."""
@@ -227,8 +267,6 @@ class RFLinkProxy:
 
     async def connect(self):
         """Set up connection and hook it into HA for reconnect/shutdown."""
-        import serial
-
         log.info("Initiating Rflink connection")
 
         # Rflink create_rflink_connection decides based on the value of host
@@ -251,16 +289,11 @@ class RFLinkProxy:
             )
 
         try:
-            with async_timeout.timeout(CONNECTION_TIMEOUT):
-                self.transport, self.protocol = await connection
-
-        except (
-            serial.serialutil.SerialException,
-            ConnectionRefusedError,
-            TimeoutError,
-            OSError,
-            asyncio.TimeoutError,
-        ) as exc:
+            self.transport, self.protocol = await asyncio.wait_for(
+                connection, CONNECTION_TIMEOUT
+            )
+
+        except CONNECT_ERRORS as exc:
             reconnect_interval = DEFAULT_RECONNECT_INTERVAL
             log.error(
                 "Error connecting to Rflink, reconnecting in %s", reconnect_interval
@@ -286,7 +319,7 @@ def main(argv=sys.argv[1:], loop=None):
     logging.basicConfig(level=level)
 
     if not loop:
-        loop = asyncio.get_event_loop()
+        loop = new_event_loop()
 
     host = args["--host"]
     port = args["--port"]
@@ -299,6 +332,7 @@ def main(argv=sys.argv[1:], loop=None):
         proxy.client_connected_callback,
         host="",
         port=listenport,
+        limit=CLIENT_LINE_LIMIT,
     )
 
     server = loop.run_until_complete(server_coro)
@@ -319,8 +353,7 @@ def main(argv=sys.argv[1:], loop=None):
         loop.run_until_complete(server.wait_closed())
 
         # cleanup server connections
-        writers = [i[1] for i in list(clients)]
-        for writer in writers:
+        for writer in list(clients):
             writer.close()
             if sys.version_info >= (3, 7):
                 loop.run_until_complete(writer.wait_closed())
@@ -329,4 +362,6 @@ def main(argv=sys.argv[1:], loop=None):
         proxy.transport.close()
 
     finally:
+        # also when the loop was stopped by other means than an interrupt
+        server.close()
         loop.close()
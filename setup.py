@@ -1,5 +1,6 @@
 """Library and CLI tools for interacting with RFlink 433MHz transceiver."""
 
+import os
 import sys
 from codecs import open
 from os import path
@@ -24,6 +25,18 @@ def version_from_git():
     ).strip()
 
 
+def compiled_extensions():
+    """Optionally compile the packet parser with mypyc (RFLINK_BUILD_EXT=1)."""
+    if os.environ.get("RFLINK_BUILD_EXT") != "1":
+        return []
+    try:
+        from mypyc.build import mypycify
+    except ImportError:
+        print("mypyc not available, not compiling extensions", file=sys.stderr)
+        return []
+    return mypycify(["rflink/parser.py"])
+
+
 setup(
     name="rflink",
     version=version_from_git(),
@@ -56,8 +69,8 @@ setup(
     keywords="rflink 433mhz domotica",
     packages=find_packages(exclude=["contrib", "docs", "tests"]),
     package_data={"rflink": ["py.typed"]},
+    ext_modules=compiled_extensions(),
     install_requires=[
-        "async_timeout",
         "docopt",
         "pyserial",
         "pyserial-asyncio",
@@ -0,0 +1,20 @@
+"""Shared fixtures for tests."""
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def loop():
+    """Fresh event loop, closed after the test."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def quick_loop(loop):
+    """Event loop that stops itself shortly after it starts running."""
+    loop.call_later(0.05, loop.stop)
+    return loop
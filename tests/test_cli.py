@@ -1,29 +1,14 @@
 """Basic testing for CLI."""
 
-import asyncio
+from unittest.mock import Mock
 
 from serial_asyncio import SerialTransport
 
-from rflink.__main__ import main
+from rflink.__main__ import main, send_commands
 
 
-def test_spawns(monkeypatch):
+def test_spawns(monkeypatch, quick_loop):
     """At least test if the CLI doesn't error on load."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    # setup task to stop CLI loop
-    async def stop():
-        """Wait and close loop."""
-        await asyncio.sleep(0.1)
-        loop.stop()
-
-    if hasattr(asyncio, "ensure_future"):
-        ensure_future = asyncio.ensure_future
-    else:  # Deprecated since Python 3.4.4
-        ensure_future = getattr(asyncio, "async")
-    ensure_future(stop(), loop=loop)
-
     # use simulation interface
     args = ["--port", "loop://", "-v"]
 
@@ -31,4 +16,19 @@ def test_spawns(monkeypatch):
     monkeypatch.setattr(SerialTransport, "_ensure_reader", lambda self: True)
 
     # test calling results in the loop close cleanly
-    assert main(args, loop=loop) is None
+    assert main(args, loop=quick_loop) is None
+
+
+def test_send_commands(loop):
+    """Every repetition of a command should be sent."""
+    sent = []
+
+    async def send_command_ack(device_id, command):
+        sent.append((device_id, command))
+        return True
+
+    protocol = Mock(send_command_ack=send_command_ack)
+
+    loop.run_until_complete(send_commands(protocol, "newkaku_000001_01", "on", 3))
+
+    assert sent == [("newkaku_000001_01", "on")] * 3
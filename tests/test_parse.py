@@ -10,11 +10,17 @@ from rflink.parser import (
     VALUE_TRANSLATION,
     decode_packet,
     deserialize_packet_id,
+    iter_packet_spans,
     serialize_packet_id,
     valid_packet,
 )
 
 PROTOCOL_SAMPLES = os.path.join(os.path.dirname(__file__), "protocol_samples.txt")
+# official protocol samples, read once at import
+with open(PROTOCOL_SAMPLES) as samples:
+    SAMPLE_PACKETS = [
+        line.strip() for line in samples if line.strip() and line[0] != "#"
+    ]
 
 
 @pytest.mark.parametrize(
@@ -93,6 +99,10 @@ PROTOCOL_SAMPLES = os.path.join(os.path.dirname(__file__), "protocol_samples.txt
             {"rts_p1": "a63f33003cf000665a5a"},
         ],
         ["20;01;setGPIO=ON;", {"setgpio": "on"}],
+        [
+            "20;75;DEBUG;Pulses=4;Pulses(uSec)=1200,2760,120,1800;",
+            {"protocol": "debug", "pulses": "4", "pulses(usec)": "1200,2760,120,1800"},
+        ],
     ],
 )
 def test_packet_parsing(packet, expect):
@@ -108,9 +118,8 @@ def test_packet_parsing(packet, expect):
     # and deserialize it again
     packet_identifiers = deserialize_packet_id(packet_id)
 
-    original = set(result.items())
-    transserialized = set(packet_identifiers.items())
-    assert transserialized.issubset(original)
+    for key, value in packet_identifiers.items():
+        assert result[key] == value
 
 
 def test_descriptions():
@@ -125,14 +134,7 @@ def test_units():
         assert key in UNITS
 
 
-@pytest.mark.parametrize(
-    "packet",
-    [
-        line.strip()
-        for line in open(PROTOCOL_SAMPLES).readlines()
-        if line.strip() and line[0] != "#"
-    ],
-)
+@pytest.mark.parametrize("packet", SAMPLE_PACKETS)
 def test_packet_valiation(packet):
     """Verify if packet validation correctly identifies official samples.
 
@@ -157,3 +159,38 @@ def test_invalid_type():
 def test_underscored(device_id):
     """Test parsing device id's that contain underscores."""
     assert deserialize_packet_id(device_id)
+
+
+def test_serialize_empty_protocol():
+    """An empty protocol should not leave a leading separator."""
+    assert serialize_packet_id({"protocol": "", "id": "ec02"}) == "ec02"
+
+
+def test_decode_cached_copy():
+    """Repeated packets should decode to equal but independent dicts."""
+    packet = "20;46;Kaku;ID=44;SWITCH=4;CMD=OFF;"
+
+    first = decode_packet(packet)
+    first["command"] = "on"
+
+    assert decode_packet(packet)["command"] == "off"
+
+
+def test_iter_packet_spans():
+    """Every line of a large buffer should be found, in order."""
+    buf = b"".join(packet.encode() + b"\r\n" for packet in SAMPLE_PACKETS * 10)
+
+    packets = [buf[start:end].decode() for start, end in iter_packet_spans(buf)]
+
+    assert packets == SAMPLE_PACKETS * 10
+
+
+def test_decode_cached_counter():
+    """Packets differing only in their counter should keep their own debug counter."""
+    assert decode_packet("20;75;DEBUG;Pulses=4;")["tm"] == "75"
+    assert decode_packet("20;76;DEBUG;Pulses=4;")["tm"] == "76"
+
+
+def test_decode_tm_attribute():
+    """A tm attribute of a regular packet should not be replaced by the counter."""
+    assert decode_packet("20;01;Foo;ID=1;TM=5;")["tm"] == "5"
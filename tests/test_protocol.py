@@ -1,10 +1,23 @@
 """Test RFlink serial low level and packet parsing protocol."""
 
-from unittest.mock import Mock
+import asyncio
+import os
+import socket
+import sys
+from datetime import timedelta
+from unittest.mock import Mock, PropertyMock, call
 
 import pytest
 
-from rflink.protocol import EventHandling, PacketHandling
+from rflink.protocol import (
+    EventHandling,
+    InverterProtocol,
+    PacketHandling,
+    RepeaterProtocol,
+    RflinkProtocol,
+    new_event_loop,
+    write_blocking,
+)
 
 COMPLETE_PACKET = b"20;E0;NewKaku;ID=cac142;SWITCH=1;CMD=ALLOFF;\r\n"
 INCOMPLETE_PART1 = b"20;E0;NewKaku;ID=cac"
@@ -33,6 +46,24 @@ def event_protocol(monkeypatch, ignore):
     return EventHandling(None, ignore=ignore)
 
 
+@pytest.fixture
+def connected_protocol(loop):
+    """Rflinkprotocol instance connected to a mocked transport."""
+    protocol = RflinkProtocol(loop)
+    protocol.connection_made(Mock())
+    return protocol
+
+
+def run_until(loop, condition):
+    """Run loop until condition is met, eg: by work done in the writer thread."""
+
+    async def wait():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(asyncio.wait_for(wait(), 1))
+
+
 def test_complete_packet(protocol):
     """Protocol should parse and output complete incoming packets."""
     protocol.data_received(COMPLETE_PACKET)
@@ -48,6 +79,15 @@ def test_split_packet(protocol):
     protocol.handle_packet.assert_called_once_with(COMPLETE_PACKET_DICT)
 
 
+def test_split_line_ending(protocol):
+    """Line ending should be allowed to arrive in pieces."""
+    protocol.data_received(COMPLETE_PACKET[:-1])
+    protocol.data_received(COMPLETE_PACKET[-1:])
+
+    protocol.handle_packet.assert_called_once_with(COMPLETE_PACKET_DICT)
+    assert not protocol.buffer
+
+
 def test_starting_incomplete(protocol):
     """An initial incomplete packet should be discarded."""
     protocol.data_received(INCOMPLETE_PART2)
@@ -57,6 +97,13 @@ def test_starting_incomplete(protocol):
     protocol.handle_packet.assert_called_once_with(COMPLETE_PACKET_DICT)
 
 
+def test_undecodable_line(protocol):
+    """Undecodable data should only drop its own line."""
+    protocol.data_received(b"20;E0;\xff\xfe;\r\n" + COMPLETE_PACKET)
+
+    protocol.handle_packet.assert_called_once_with(COMPLETE_PACKET_DICT)
+
+
 def test_multiple_packets(protocol):
     """Multiple packets should be parsed."""
     protocol.data_received(COMPLETE_PACKET)
@@ -66,6 +113,15 @@ def test_multiple_packets(protocol):
     protocol.handle_packet.assert_called_with(COMPLETE_PACKET_DICT)
 
 
+def test_multiple_packets_one_chunk(protocol):
+    """Multiple packets arriving at once should all be parsed, keeping the remainder."""
+    protocol.data_received(COMPLETE_PACKET * 2 + INCOMPLETE_PART1)
+    protocol.data_received(INCOMPLETE_PART2)
+
+    assert protocol.handle_packet.call_count == 3
+    protocol.handle_packet.assert_called_with(COMPLETE_PACKET_DICT)
+
+
 @pytest.mark.parametrize(
     "ignore,expected",
     [
@@ -89,3 +145,214 @@ def test_ignore(event_protocol, expected):
     event_protocol.data_received(COMPLETE_PACKET)
 
     assert event_protocol.handle_event.call_count == expected, event_protocol.ignore
+
+
+def test_parse_failure(protocol, monkeypatch, caplog):
+    """Packets failing to parse should be logged and skipped."""
+    monkeypatch.setattr(
+        "rflink.protocol.decode_packet", Mock(side_effect=ValueError("bad packet"))
+    )
+    protocol.data_received(COMPLETE_PACKET)
+
+    protocol.handle_packet.assert_not_called()
+    assert "failed to parse packet data" in caplog.text
+
+
+def test_events_without_packet_callback(monkeypatch, capsys):
+    """Event handling should not print packets, unless a packet callback is set."""
+    packet_callback = Mock()
+    monkeypatch.setattr(EventHandling, "handle_event", Mock())
+    EventHandling(None).data_received(COMPLETE_PACKET)
+    EventHandling(None, packet_callback=packet_callback).data_received(COMPLETE_PACKET)
+
+    assert capsys.readouterr().out == ""
+    packet_callback.assert_called_once_with(COMPLETE_PACKET_DICT)
+
+
+def test_send_raw_packet(connected_protocol):
+    """Packets should be written to the transport right away."""
+    connected_protocol.send_raw_packet("10;PING;")
+
+    connected_protocol.transport.write.assert_called_once_with(b"10;PING;\r\n")
+
+
+def test_threaded_writes(loop):
+    """Serial writes should be completed from the writer thread."""
+    protocol = PacketHandling(loop, threaded_writes=True)
+    read_fd, write_fd = os.pipe()
+    port = Mock()
+    port.fileno.return_value = write_fd
+    # non-blocking port, first write only partially fits the output buffer
+    port.write.side_effect = [4, 6]
+    transport = Mock()
+    transport.get_extra_info.return_value = port
+    protocol.connection_made(transport)
+
+    try:
+        protocol.send_raw_packet("10;PING;")
+        run_until(loop, lambda: port.write.call_count == 2)
+    finally:
+        protocol.connection_lost(None)
+        os.close(read_fd)
+        os.close(write_fd)
+
+    assert port.write.call_count == 2
+    assert bytes(port.write.call_args[0][0]) == b"ING;\r\n"
+    protocol.transport.write.assert_not_called()
+
+
+def test_threaded_write_failure(loop, caplog):
+    """Failing writes from the writer thread should be logged."""
+    protocol = PacketHandling(loop, threaded_writes=True)
+    port = Mock()
+    port.fileno.side_effect = OSError("port closed")
+    transport = Mock()
+    transport.get_extra_info.return_value = port
+    protocol.connection_made(transport)
+
+    protocol.send_raw_packet("10;PING;")
+    run_until(loop, lambda: "failed to write to serial port" in caplog.text)
+    protocol.connection_lost(None)
+
+
+def test_write_blocking_stalled_port(monkeypatch):
+    """Writing to a stalled port should stop once the port is closed."""
+    monkeypatch.setattr("rflink.protocol.WRITE_POLL_INTERVAL", 0.01)
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
+    try:
+        # fill the pipe so it never becomes writable
+        with pytest.raises(BlockingIOError):
+            while True:
+                os.write(write_fd, b"X" * 4096)
+        port = Mock()
+        port.fileno.return_value = write_fd
+        type(port).is_open = PropertyMock(side_effect=[True, False])
+
+        write_blocking(port, b"10;PING;\r\n")
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+    port.write.assert_not_called()
+
+
+def test_tcp_socket_options():
+    """TCP connections should get the configured keepalive options."""
+    protocol = PacketHandling(
+        Mock(), keepalive=60, keepalive_interval=5, keepalive_count=2
+    )
+    transport = Mock()
+    sock = transport.get_extra_info.return_value
+    sock.family = socket.AF_INET
+
+    protocol.connection_made(transport)
+
+    sock.setsockopt.assert_has_calls(
+        [
+            call(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            call(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+            call(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5),
+            call(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2),
+        ]
+    )
+
+
+def test_serial_no_socket_options():
+    """Serial connections have no socket to configure."""
+    protocol = PacketHandling(Mock(), keepalive=60)
+    transport = Mock()
+    transport.get_extra_info.return_value = None
+
+    protocol.connection_made(transport)
+
+
+def test_log_all_flush(loop, tmp_path, monkeypatch):
+    """Logged packets should be flushed once per interval, not per packet."""
+    monkeypatch.setattr("rflink.protocol.LOG_FLUSH_INTERVAL", 0)
+    protocol = PacketHandling(loop)
+    log_file = tmp_path / "rflink.log"
+    protocol.log_all(str(log_file))
+    try:
+        protocol.data_received(COMPLETE_PACKET * 2)
+        # not flushed until the timer fires
+        assert log_file.read_bytes() == b""
+
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+    finally:
+        protocol.log_all(None)
+
+    assert log_file.read_bytes() == COMPLETE_PACKET.replace(b"\r", b"") * 2
+
+
+def test_new_event_loop_fallback(monkeypatch):
+    """Without uvloop a standard asyncio event loop should be used."""
+    monkeypatch.setitem(sys.modules, "uvloop", None)
+    monkeypatch.setattr(asyncio, "set_event_loop", Mock())
+    loop = new_event_loop()
+    loop.close()
+
+    assert isinstance(loop, asyncio.AbstractEventLoop)
+    asyncio.set_event_loop.assert_called_once_with(loop)
+
+
+def test_send_command_ack(loop, connected_protocol):
+    """Command should resolve with the response of the gateway."""
+    protocol = connected_protocol
+
+    async def send():
+        task = loop.create_task(protocol.send_command_ack("newkaku_000001_01", "on"))
+        # let command be sent, before responding
+        await asyncio.sleep(0)
+        protocol.data_received(b"20;01;OK;\r\n")
+        return await task
+
+    assert loop.run_until_complete(send()) is True
+
+    protocol.transport.write.assert_called_once_with(b"10;newkaku;000001;01;on;\r\n")
+
+
+def test_send_command_ack_timeout(loop, connected_protocol, monkeypatch):
+    """Command without response should not be acknowledged."""
+    monkeypatch.setattr("rflink.protocol.TIMEOUT", timedelta(seconds=0))
+    protocol = connected_protocol
+
+    assert (
+        loop.run_until_complete(protocol.send_command_ack("newkaku_000001_01", "on"))
+        is False
+    )
+    # late response is ignored
+    protocol.data_received(b"20;01;OK;\r\n")
+
+
+@pytest.mark.parametrize(
+    "protocol_type,command", [(InverterProtocol, "on"), (RepeaterProtocol, "alloff")]
+)
+def test_resend_event(protocol_type, command):
+    """Switch events should be sent back out, inverted or repeated."""
+    protocol = protocol_type(Mock())
+    protocol.send_command_ack = Mock()
+
+    protocol.data_received(COMPLETE_PACKET)
+
+    protocol.send_command_ack.assert_called_once_with("newkaku_cac142_1", command)
+    protocol.loop.create_task.assert_called_once_with(
+        protocol.send_command_ack.return_value
+    )
+
+
+def test_send_command_ack_invalid(loop, connected_protocol):
+    """Invalid commands should fail without waiting for earlier commands."""
+    protocol = connected_protocol
+
+    async def send():
+        earlier = loop.create_task(protocol.send_command_ack("newkaku_000001_01", "on"))
+        # let earlier command be sent, it now waits for its acknowledgement
+        await asyncio.sleep(0)
+        with pytest.raises(KeyError):
+            await asyncio.wait_for(protocol.send_command_ack("newkaku_000001", "on"), 1)
+        protocol.data_received(b"20;01;OK;\r\n")
+        return await earlier
+
+    assert loop.run_until_complete(send()) is True
@@ -1,29 +1,40 @@
 """Basic testing for proxy."""
 
 import asyncio
+import socket
+from unittest.mock import ANY, Mock
 
+import pytest
 from serial_asyncio import SerialTransport
 
-from rflinkproxy.__main__ import main
+from rflinkproxy.__main__ import (
+    CLIENT_LINE_LIMIT,
+    DEFAULT_RECONNECT_INTERVAL,
+    RFLinkProxy,
+    clients,
+    decode_tx_packet,
+    main,
+)
 
 
-def test_spawns(monkeypatch):
-    """At least test if the CLI doesn't error on load."""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+@pytest.fixture
+def proxy(loop):
+    """Proxy instance with a mocked gateway protocol."""
+    proxy = RFLinkProxy(loop=loop)
+    proxy.protocol = Mock()
+    return proxy
+
 
-    # setup task to stop CLI loop
-    async def stop():
-        """Wait and close loop."""
-        await asyncio.sleep(0.1)
-        loop.stop()
+@pytest.fixture
+def writer():
+    """Stream writer of a connected client, mocked."""
+    writer = Mock()
+    writer.get_extra_info.return_value = ("::1", 1234)
+    return writer
 
-    if hasattr(asyncio, "ensure_future"):
-        ensure_future = asyncio.ensure_future
-    else:  # Deprecated since Python 3.4.4
-        ensure_future = getattr(asyncio, "async")
-    ensure_future(stop(), loop=loop)
 
+def test_spawns(monkeypatch, quick_loop):
+    """At least test if the CLI doesn't error on load."""
     # use simulation interface
     args = ["--port", "loop://", "-v"]
 
@@ -31,4 +42,109 @@ def test_spawns(monkeypatch):
     monkeypatch.setattr(SerialTransport, "_ensure_reader", lambda self: True)
 
     # test calling results in the loop close cleanly
-    assert main(args, loop=loop) is None
+    assert main(args, loop=quick_loop) is None
+
+
+def test_raw_callback(monkeypatch):
+    """Received packets should be forwarded to all connected clients."""
+    writers = [Mock(), Mock()]
+    for writer in writers:
+        writer.transport.get_write_buffer_size.return_value = 0
+        monkeypatch.setitem(clients, writer, (Mock(), ("::1", 1234)))
+
+    RFLinkProxy().raw_callback("20;00;Xiron;ID=4001;TEMP=00f1;HUM=38;BAT=LOW;")
+
+    for writer in writers:
+        writer.write.assert_called_once_with(
+            b"20;00;Xiron;ID=4001;TEMP=00f1;HUM=38;BAT=LOW;\r\n"
+        )
+
+
+def test_raw_callback_slow_client(monkeypatch):
+    """Clients not reading their data should be disconnected."""
+    writer = Mock()
+    writer.transport.get_write_buffer_size.return_value = 1024 * 1024
+    monkeypatch.setitem(clients, writer, (Mock(), ("::1", 1234)))
+
+    RFLinkProxy().raw_callback("20;00;Xiron;ID=4001;TEMP=00f1;HUM=38;BAT=LOW;")
+
+    writer.transport.abort.assert_called_once_with()
+    writer.write.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "packet,expected",
+    [
+        [
+            "10;NewKaku;0cac142;3;ON;",
+            {"id": "0cac142", "switch": "3", "command": "ON"},
+        ],
+        ["10;Kaku;41;1;ON;", {"id": "000041", "switch": "1", "command": "ON"}],
+        ["10;MERTIK;64;UP;", {"id": "64", "switch": "UP"}],
+        ["10;DELTRONIC;001c33;", {"id": "001c33"}],
+    ],
+)
+def test_decode_tx_packet(packet, expected):
+    """Client packets should be broken down into positional fields."""
+    expected = dict(expected, node="master", protocol=packet.split(";")[1].lower())
+    assert decode_tx_packet(packet) == expected
+
+
+def test_client_lines(loop, proxy, writer):
+    """Client lines should be completed, invalid ones dropped without disconnecting."""
+
+    async def connect():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"\r\n10;\xff\xfe;\r\n10;PING\r\n")
+        reader.feed_eof()
+        await proxy.client_connected_callback(reader, writer)
+
+    loop.run_until_complete(connect())
+
+    proxy.protocol.send_raw_packet.assert_called_once_with("10;PING;")
+    writer.close.assert_called_once_with()
+
+
+@pytest.mark.parametrize(
+    "chunks,expected",
+    [
+        # line end of the overlong line already received
+        [[b"10;" + b"X" * CLIENT_LINE_LIMIT + b";\r\n10;PING;\r\n"], "10;PING;"],
+        # rest of the overlong line arrives later, it should not be sent either
+        [
+            [b"X" * 3 * CLIENT_LINE_LIMIT, b"10;PING;\r\n", b"10;VERSION;\r\n"],
+            "10;VERSION;",
+        ],
+    ],
+)
+def test_client_overlong_line(loop, proxy, writer, chunks, expected):
+    """Overlong client lines should be dropped without disconnecting."""
+
+    async def connect():
+        reader = asyncio.StreamReader(limit=CLIENT_LINE_LIMIT)
+        task = loop.create_task(proxy.client_connected_callback(reader, writer))
+        for chunk in chunks:
+            reader.feed_data(chunk)
+            # let the client handler read it
+            await asyncio.sleep(0)
+        reader.feed_eof()
+        await task
+
+    loop.run_until_complete(connect())
+
+    proxy.protocol.send_raw_packet.assert_called_once_with(expected)
+
+
+def test_connect_failure(loop):
+    """Failing to connect to the gateway should schedule a reconnect."""
+    # find a port nothing is listening on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    loop.call_later = Mock()
+    proxy = RFLinkProxy(host="127.0.0.1", port=port, loop=loop)
+
+    loop.run_until_complete(proxy.connect())
+
+    assert proxy.protocol is None
+    loop.call_later.assert_called_with(DEFAULT_RECONNECT_INTERVAL, proxy.reconnect, ANY)